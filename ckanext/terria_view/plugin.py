@@ -1,66 +1,451 @@
 import ckan.plugins as plugins
 import ckan.plugins.toolkit as toolkit
 import json
-import urllib
-import re
+import logging
+import math
+import urllib.parse
 import functools
 import os
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 from ckan.lib import base, uploader
-from flask import abort
+import ckan.logic.action.get as ckan_get
+from flask import has_request_context, request
+from ckanext.terria_view.viridis import VIRIDIS_RGB
+
+log = logging.getLogger(__name__)
+
+try:
+    import orjson
+
+    def _json_bytes(obj):
+        return orjson.dumps(obj)
+except ImportError:
+    def _json_bytes(obj):
+        return json.dumps(obj, separators=(',', ':')).encode('utf-8')
+
+# GeoTIFF styling through TiTiler needs httpx and numpy; without them TIFF
+# resources are previewed like any other format
+try:
+    import httpx
+    import numpy as np
+    VIRIDIS_LUT = np.array([rgb + (255,) for rgb in VIRIDIS_RGB], dtype=np.uint8)
+    HAS_COG_SUPPORT = True
+except ImportError:
+    HAS_COG_SUPPORT = False
 
 SUPPORTED_FORMATS = ['shp','wms', 'wfs', 'kml', 'esri rest', 'geojson', 'czml', 'csv-geo-*','tif','tiff','geotiff']
 #SUPPORTED_FORMATS = ['shp','wms', 'wfs', 'kml', 'esri rest', 'geojson', 'czml', 'csv-geo-*']
 SUPPORTED_FILTER_EXPR = 'fq=(' + ' OR '.join(['res_format:' + s for s in SUPPORTED_FORMATS]) + ')'
 SUPPORTED_FORMATS_REGEX = '^(' + '|'.join([s.replace('*', '.*') for s in SUPPORTED_FORMATS]) +')$'
-
-def can_view_resource(resource):
-    format_ = resource.get('format', '')
+# Same matching as SUPPORTED_FORMATS_REGEX without running the regex engine
+SUPPORTED_FORMATS_EXACT = frozenset(s for s in SUPPORTED_FORMATS if not s.endswith('*'))
+SUPPORTED_FORMATS_PREFIXES = tuple(s[:-1] for s in SUPPORTED_FORMATS if s.endswith('*'))
+# Uploaded formats that are linked through the resource uploader
+UPLOAD_FORMATS = frozenset(['shp', 'kml', 'geojson', 'czml', 'csv-geo-au', 'csv-geo-nz', 'csv-geo-us', 'tif', 'tiff', 'geotiff'])
+TIFF_FORMATS = frozenset(['tif', 'tiff', 'geotiff'])
+VALID_DOMAIN_PREFIXES = ('https://data.dev-wins.com', 'https://ihp-wins.unesco.org/')
+
+# Lowercased resource format, falling back to the url extension
+def get_resource_format(resource):
+    format_ = resource.get('format') or ''
     if format_ == '':
         format_ = os.path.splitext(resource['url'])[1][1:]
+    return format_.lower()
 
-    return re.match(SUPPORTED_FORMATS_REGEX, format_.lower()) != None
+def can_view_resource(resource):
+    format_ = get_resource_format(resource)
+    return format_ in SUPPORTED_FORMATS_EXACT or format_.startswith(SUPPORTED_FORMATS_PREFIXES)
 
-import ckan.logic.action.get as get
-resource_view_list = get.resource_view_list
+# Core action, bound directly: toolkit.get_action('resource_view_list') would
+# resolve to new_resource_view_list itself once get_actions() is registered.
+core_resource_view_list = ckan_get.resource_view_list
 
 PLUGIN_NAME = 'terria_view'
 
+_SYSADMIN_CONTEXT = {'user': 'ckan.system', 'ignore_auth': True}
+
+# Resources for which creating the default view failed recently; retried once
+# the entry expires
+FAILED_VIEW_CREATE_TTL = 300
+FAILED_VIEW_CREATE_SIZE = 1024
+_failed_view_creates = {}
+
 def new_resource_view_list(plugin, context, data_dict):
+    resource_id = data_dict.get('id')
     try:
-        resource_id = data_dict.get('id')
-        resource = toolkit.get_action('resource_show')(context, {'id': resource_id})
-        if not resource:
-            abort(404, description='Resource not found')   
-        ret = resource_view_list(context, data_dict)
-    except:
-        ret = []
-    has_plugin = len([r for r in ret if r['view_type'] == PLUGIN_NAME]) > 0
-    if not has_plugin:
-        if can_view_resource(context['resource'].__dict__):
-            data_dict2 = {
-                'resource_id': data_dict['id'],
-                'title': plugin.default_title,
-                'view_type': 'terria_view',
-                'description': '',
-                'terria_instance_url': '//ihp-wins.unesco.org/terria/'
+        ret = core_resource_view_list(context, data_dict)
+    except toolkit.ObjectNotFound:
+        # Left to CKAN, which answers with a JSON or HTML 404 as appropriate
+        raise
+    except Exception:
+        return []
+    # Steady state: the view exists, or creating it failed recently
+    if cache_get(_failed_view_creates, resource_id) is not None or any(r['view_type'] == PLUGIN_NAME for r in ret):
+        return ret
+    # Old dataset versions from the activity stream must not get new views
+    if has_request_context() and 'activity_id' in request.args:
+        return ret
+    # The core action leaves the resource object in the context
+    resource = context['resource']
+    # Formats the plugin cannot preview never get a default view
+    if not can_view_resource({'format': resource.format, 'url': resource.url}):
+        return ret
+    data_dict2 = dict(plugin.default_view, resource_id=data_dict['id'])
+    sysadmin_context = dict(_SYSADMIN_CONTEXT, model=context['model'], session=context['session'])
+    try:
+        created = toolkit.get_action('resource_view_create')(sysadmin_context, data_dict2)
+    except Exception:
+        cache_set(_failed_view_creates, resource_id, True, FAILED_VIEW_CREATE_TTL, FAILED_VIEW_CREATE_SIZE)
+        raise
+    ret.append(created)
+    return ret
+
+# JSON punctuation that may stay unescaped in the #start= url fragment; keeps
+# the iframe url short for large colormaps
+CONFIG_SAFE_CHARS = ':,/@'
+
+# In-process caches: key -> (expires_at, value), evicted oldest first
+_cache_lock = threading.Lock()
+
+def cache_get(cache, key):
+    with _cache_lock:
+        cached = cache.get(key)
+    if cached is not None and cached[0] > time.time():
+        return cached[1]
+    return None
+
+def cache_set(cache, key, value, ttl, max_size):
+    with _cache_lock:
+        if key not in cache and len(cache) >= max_size:
+            cache.pop(next(iter(cache)))
+        cache[key] = (time.time() + ttl, value)
+
+# TiTiler results per COG url
+TITILER_CACHE_TTL = 3600
+TITILER_CACHE_SIZE = 1024
+_titiler_cache = {}
+# Time allowed per TiTiler endpoint, retries included
+TITILER_ENDPOINT_BUDGET = 10.0
+# COG urls whose lookup failed recently; renders skip TiTiler for them until
+# the entry expires instead of waiting on it again during an outage
+TITILER_FAILURE_TTL = 60
+_titiler_failures = {}
+
+# Encoded Terria configs per resource and package revision
+CONFIG_CACHE_TTL = 600
+CONFIG_CACHE_SIZE = 4096
+_config_cache = {}
+_http_client = None
+
+# Shared keep-alive client so TiTiler requests reuse pooled connections
+def get_http_client():
+    global _http_client
+    if _http_client is None:
+        with _cache_lock:
+            if _http_client is None:
+                _http_client = httpx.Client(
+                    timeout=30.0,
+                    limits=httpx.Limits(max_connections=16, max_keepalive_connections=8)
+                )
+    return _http_client
+
+# Exponential backoff with jitter so workers don't retry in lockstep
+def retry_delay(attempt, base_delay=0.5, max_delay=10.0):
+    delay = min(max_delay, base_delay * (2 ** attempt))
+    return delay + random.uniform(0, 0.3 * delay)
+
+def fetch_with_retries(endpoint, params, retries=3, timeout=None, deadline=None):
+    if timeout is None:
+        timeout = httpx.Timeout(8.0, connect=2.0)
+    client = get_http_client()
+    for attempt in range(retries):
+        if deadline is not None:
+            # Shrink the last attempts so they end by the caller's deadline
+            remaining = max(deadline - time.monotonic(), 0.1)
+            timeout = httpx.Timeout(min(8.0, remaining), connect=min(2.0, remaining))
+        try:
+            response = client.get(endpoint, params=params, timeout=timeout)
+            response.raise_for_status()
+            return response
+        except httpx.ReadTimeout:
+            log.warning("Timeout al intentar acceder a %s (intento %d de %d)", endpoint, attempt + 1, retries)
+            if not wait_before_retry(attempt, retries, deadline):
+                raise
+        except httpx.RequestError as exc:
+            log.warning("Error en la solicitud: %s (intento %d de %d)", exc, attempt + 1, retries)
+            if not wait_before_retry(attempt, retries, deadline):
+                raise
+
+# Sleeps before the next attempt and returns True, or returns False when no
+# attempt is left or the backoff would run past the deadline
+def wait_before_retry(attempt, retries, deadline):
+    delay = retry_delay(attempt)
+    if attempt >= retries - 1 or (deadline is not None and time.monotonic() + delay >= deadline):
+        return False
+    time.sleep(delay)
+    return True
+
+# Tries each TiTiler base url in turn, returning the one that answered. Each
+# endpoint gets TITILER_ENDPOINT_BUDGET seconds; endpoints with a fallback
+# after them get a single attempt so an unresponsive primary fails over
+# quickly, while the last one keeps its retries.
+def fetch_from_titiler(titiler_urls, path, params):
+    for i, titiler_url in enumerate(titiler_urls):
+        is_last = i == len(titiler_urls) - 1
+        deadline = time.monotonic() + TITILER_ENDPOINT_BUDGET
+        try:
+            return titiler_url, fetch_with_retries(titiler_url + path, params, retries=3 if is_last else 1, deadline=deadline)
+        except httpx.HTTPError as exc:
+            log.warning("TiTiler %s no disponible: %s", titiler_url, exc)
+            if is_last:
+                raise
+
+def get_statistics_and_color_scale(url: str, titiler_urls):
+    titiler_url, response = fetch_from_titiler(titiler_urls, "/cog/statistics", {"url": url})
+    titiler_tiles_endpoint = titiler_url + "/cog/tiles/WebMercatorQuad/{z}/{x}/{y}.png"
+
+    stats = response.json()
+    log.debug("TiTiler statistics for %s: %s", url, stats)
+
+    first_band = next(iter(stats.keys()))
+    band_stats = stats[first_band]
+
+    histogram_counts = band_stats["histogram"][0]
+    bins = band_stats["histogram"][1]
+
+    num_bins = len(bins) - 1
+
+    colormap = []
+
+    if num_bins < 2:
+        colormap.append(([band_stats["min"], band_stats["max"]], [0, 0, 255, 255]))
+    else:
+        # Busier bins get up to three sub-ranges; empty histograms get one each
+        counts = np.asarray(histogram_counts, dtype=np.float64)
+        max_count = counts.max()
+        # Divide before scaling: max_count * (3.0 / max_count) can round above 3
+        if max_count > 0:
+            ranges_per_bin = np.maximum(np.ceil(counts / max_count * 3), 1).astype(np.int64)
+        else:
+            ranges_per_bin = np.ones(len(counts), dtype=np.int64)
+
+        total_ranges = int(np.sum(ranges_per_bin))
+
+        # Every bin is split into ranges_per_bin[i] equal sub-ranges
+        bin_edges = np.asarray(bins, dtype=float)
+        range_bin_starts = np.repeat(bin_edges[:-1], ranges_per_bin)
+        range_steps = np.repeat(np.diff(bin_edges) / ranges_per_bin, ranges_per_bin)
+        range_offsets = np.arange(total_ranges) - np.repeat(np.cumsum(ranges_per_bin) - ranges_per_bin, ranges_per_bin)
+        range_starts = range_bin_starts + range_offsets * range_steps
+        range_ends = range_bin_starts + (range_offsets + 1) * range_steps
+        # Sample viridis the way matplotlib's get_cmap('viridis', total_ranges) does
+        lut_index = np.minimum((np.linspace(0, 1, total_ranges) * len(VIRIDIS_LUT)).astype(int), len(VIRIDIS_LUT) - 1)
+        colors = VIRIDIS_LUT[lut_index]
+
+        colormap = [([start, end], color) for start, end, color in zip(range_starts.tolist(), range_ends.tolist(), colors.tolist())]
+
+    cmap_param = _json_bytes(colormap).decode('utf-8')
+    request_url = f"{titiler_tiles_endpoint}?url={url}&bidx=1&colormap={cmap_param}"
+    return request_url, colormap
+
+def generate_color_list(colormap):
+    # Hex-encode every RGB triple in one bytes.hex() call
+    hex_colors = bytes(channel for _, color in colormap for channel in color[:3]).hex()
+    return [
+        {"title": f"{int(color_range[0])} - {int(color_range[1])}", "color": '#' + hex_colors[6 * i:6 * i + 6]}
+        for i, (color_range, _) in enumerate(colormap)
+    ]
+
+def get_zoom_levels(url: str, titiler_urls):
+    _, response = fetch_from_titiler(titiler_urls, "/cog/info", {"url": url})
+    info = response.json()
+    bounds = info.get("bounds", None)
+    minzoom = info.get("minzoom", None)
+    maxzoom = info.get("maxzoom", None)
+    return bounds, minzoom, maxzoom
+
+# Returns (tiles_url, color_scale_list, bounds, minzoom, maxzoom) for a COG,
+# asking TiTiler only when the url is not cached or its entry has expired.
+# Returns None when no TiTiler endpoint could be reached or answered with
+# unusable data, or the optional GeoTIFF dependencies are not installed.
+def get_cog_rendering(url, titiler_urls):
+    if not HAS_COG_SUPPORT:
+        return None
+
+    cached = cache_get(_titiler_cache, url)
+    if cached is not None:
+        return cached
+    if cache_get(_titiler_failures, url) is not None:
+        return None
+
+    try:
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            statistics = executor.submit(get_statistics_and_color_scale, url, titiler_urls)
+            zoom_levels = executor.submit(get_zoom_levels, url, titiler_urls)
+            result_url, colormap = statistics.result()
+            bounds, minzoom, maxzoom = zoom_levels.result()
+    except (httpx.HTTPError, ValueError, KeyError, IndexError, TypeError, StopIteration) as exc:
+        log.error("No se pudo generar la vista COG para %s: %s", url, exc)
+        cache_set(_titiler_failures, url, True, TITILER_FAILURE_TTL, TITILER_CACHE_SIZE)
+        return None
+    color_scale_list = generate_color_list(colormap)
+
+    log.debug("Generated URL: %s", result_url)
+    log.debug("Generated Color Scale List: %s", color_scale_list)
+    log.debug("Bounds, Min Zoom, Max Zoom: %s %s %s", bounds, minzoom, maxzoom)
+
+    rendering = (result_url, color_scale_list, bounds, minzoom, maxzoom)
+    cache_set(_titiler_cache, url, rendering, TITILER_CACHE_TTL, TITILER_CACHE_SIZE)
+    return rendering
+
+# Url of an uploaded file as served by the resource uploader, memoized for
+# the current request only since uploaders may return signed urls
+def get_uploaded_url(resource, resource_url):
+    uploaded_urls = toolkit.g.get('terria_view_uploaded_urls')
+    if uploaded_urls is None:
+        uploaded_urls = toolkit.g.terria_view_uploaded_urls = {}
+    key = (resource['id'], resource_url)
+    if key not in uploaded_urls:
+        upload = uploader.get_resource_uploader(resource)
+        uploaded_urls[key] = upload.get_url_from_filename(resource['id'], resource_url)
+    return uploaded_urls[key]
+
+# Package extent fields with their defaults and valid range
+BBOX_FIELDS = (
+    ('ymax', 20.0, 90.0),
+    ('xmax', -13.0, 180.0),
+    ('ymin', -60.0, 90.0),
+    ('xmin', -108.0, 180.0)
+)
+
+# Returns the package (ymax, xmax, ymin, xmin), clamped to valid latitudes and
+# longitudes, using the default for any missing or unparsable value
+def clean_bbox(package):
+    bbox = []
+    for field, default, limit in BBOX_FIELDS:
+        try:
+            value = float(str(package.get(field)).strip())
+        except ValueError:
+            value = default
+        if not math.isfinite(value):
+            value = default
+        bbox.append(max(-limit, min(limit, value)))
+    return tuple(bbox)
+
+def build_cog_config(name, tiles_url, color_scale_list, minzoom, maxzoom, camera):
+    return {
+        "version": "8.0.0",
+        "initSources": [
+            {
+                "catalog": [
+                    {
+                        "id": name,
+                        "name": name,
+                        "type": "url-template-imagery",
+                        "url": tiles_url,
+                        "cacheDuration": "5m",
+                        "isOpenInWorkbench": True,
+                        "minimumLevel": minzoom,
+                        "maximumLevel": maxzoom,
+                        "opacity": 0.8,
+                        "legends": [
+                            {
+                                "title": name,
+                                "items": color_scale_list
+                            }
+                        ]
+                    }
+                ],
+                "homeCamera": camera,
+                "initialCamera": camera,
+                "stratum": "user",
+                "workbench": [
+                    name
+                ],
+                "viewerMode": "2D",
+                "focusWorkbenchItems": True,
+                "baseMaps": {
+                    "defaultBaseMapId": "basemap-positron",
+                    "previewBaseMapId": "basemap-positron"
+                }
             }
-            sysadmin_context = {
-                'model': context['model'],
-                'session': context['session'],
-                'user': 'ckan.system',
-                'ignore_auth': True
+        ]
+    }
+
+def build_group_config(name, format_, url, camera):
+    group_id = "//" + name
+    return {
+        "version": "8.0.0",
+        "initSources": [
+            {
+                "catalog": [
+                    {
+                        "name": name,
+                        "type": "group",
+                        "isOpen": True,
+                        "members": [
+                            {
+                                "id": name,
+                                "name": name,
+                                "type": format_,
+                                "url": url,
+                                "cacheDuration": "5m",
+                                "isOpenInWorkbench": True
+                            }
+                        ]
+                    }
+                ],
+                "homeCamera": camera,
+                "initialCamera": camera,
+                "stratum": "user",
+                "models": {
+                    group_id: {
+                        "isOpen": True,
+                        "knownContainerUniqueIds": [
+                            "/"
+                        ],
+                        "type": "group"
+                    },
+                    name: {
+                        "show": True,
+                        "isOpenInWorkbench": True,
+                        "knownContainerUniqueIds": [
+                            group_id
+                        ],
+                        "type": format_
+                    },
+                    "/": {
+                        "type": "group"
+                    }
+                },
+                "workbench": [
+                    name
+                ],
+                "viewerMode": "3dSmooth",
+                "focusWorkbenchItems": True,
+                "baseMaps": {
+                    "defaultBaseMapId": "basemap-positron",
+                    "previewBaseMapId": "basemap-positron"
+                }
             }
-            toolkit.get_action('resource_view_create')(sysadmin_context, data_dict2)
-            ret = resource_view_list(context, data_dict)
-            
-    return ret
+        ]
+    }
 
 class Terria_ViewPlugin(plugins.SingletonPlugin):
     site_url = ''
     default_title = 'Terria Viewer'
     default_instance_url = '//ihp-wins.unesco.org/terria/'
+    titiler_urls = ('https://titiler.dev-wins.com',)
     resource_view_list_callback = None
   
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        # Translated titles per language
+        self._info_cache = {}
+
     plugins.implements(plugins.IConfigurer)
     def update_config(self, config_):
         toolkit.add_template_directory(config_, 'templates')
@@ -70,14 +455,32 @@ class Terria_ViewPlugin(plugins.SingletonPlugin):
         self.site_url = config.get('ckan.site_url', self.site_url)
         self.default_title = config.get('ckanext.' + PLUGIN_NAME + '.default_title', self.default_title)
         self.default_instance_url = config.get('ckanext.' + PLUGIN_NAME + '.default_instance_url', self.default_instance_url)
+        titiler_url = config.get('ckanext.' + PLUGIN_NAME + '.titiler_url', self.titiler_urls[0])
+        titiler_backup_url = config.get('ckanext.' + PLUGIN_NAME + '.titiler_backup_url')
+        self.titiler_urls = tuple(u.rstrip('/') for u in (titiler_url, titiler_backup_url) if u)
+        self.default_view = {
+            'title': self.default_title,
+            'view_type': PLUGIN_NAME,
+            'description': '',
+            'terria_instance_url': self.default_instance_url
+        }
         self.resource_view_list_callback = functools.partial(new_resource_view_list, self)
+        self._info_cache = {}
     
     plugins.implements(plugins.IResourceView, inherit=True)
     def info(self):
+        try:
+            lang = toolkit.h.lang()
+        except Exception:
+            lang = ''
+        titles = self._info_cache.get(lang)
+        if titles is None:
+            titles = self._info_cache[lang] = (toolkit._('TerriaJS Preview'), toolkit._(self.default_title))
+        # Built per call so callers cannot alter the cached titles
         return {
             'name': PLUGIN_NAME,
-            'title': toolkit._('TerriaJS Preview'),
-            'default_title': toolkit._(self.default_title),
+            'title': titles[0],
+            'default_title': titles[1],
             'icon': 'globe',
             'always_available': True,
             'iframed': False,
@@ -92,280 +495,71 @@ class Terria_ViewPlugin(plugins.SingletonPlugin):
     def setup_template_variables(self, context, data_dict):
         package = data_dict['package']
         resource = data_dict['resource']
+        view = data_dict['resource_view']
+
+        if not can_view_resource(resource):
+            return self.template_variables(view, '')
+
         resource_id = resource['id']
         organization = package['organization']
         name = package['name']
         organization_id = organization['id']
-        view = data_dict['resource_view']
-        view_title = view.get('title', self.default_title)
-        view_terria_instance_url = view.get('terria_instance_url', self.default_instance_url)
         
-        # Contexto con información del usuario
-        user_context = {
-            'user': toolkit.g.user, 
-            'auth_user_obj': toolkit.g.userobj
-        }
-
-        def is_accepted_format(resource):
-            accepted_formats = ['shp', 'kml', 'geojson', 'czml', 'csv-geo-au', 'csv-geo-nz', 'csv-geo-us', 'tif','tiff','geotiff']
-            resource_format = resource["format"].lower()
-            return any(resource_format == format for format in accepted_formats)
-
-        def is_valid_domain(url):
-            return url.startswith('https://data.dev-wins.com') or url.startswith('https://ihp-wins.unesco.org/')
-
-        if is_valid_domain(resource["url"]):
-            if is_accepted_format(resource):
-                if user_context['user']:
-                    upload = uploader.get_resource_uploader(resource)
-                    uploaded_url = upload.get_url_from_filename(resource_id, resource['url'])
-                else:
-                    uploaded_url = resource["url"]
-            else:
-                uploaded_url = resource["url"]
+        # Usuario actual, leído una sola vez del contexto de la petición
+        g_user = toolkit.g.user
+
+        format_lower = get_resource_format(resource)
+        resource_url = resource['url']
+        uses_uploader = bool(g_user) and resource_url.startswith(VALID_DOMAIN_PREFIXES) and format_lower in UPLOAD_FORMATS
+
+        # Uploader urls may be signed and short lived, so those configs are
+        # never cached; the rest only change with the resource and the
+        # package bounds
+        config_key = (
+            resource_id,
+            resource.get('last_modified') or resource.get('metadata_modified'),
+            package.get('metadata_modified')
+        )
+        if uses_uploader:
+            uploaded_url = get_uploaded_url(resource, resource_url)
         else:
-            uploaded_url = resource["url"]
+            encoded_config = cache_get(_config_cache, config_key)
+            if encoded_config is not None:
+                return self.template_variables(view, encoded_config)
+            uploaded_url = resource_url
           
-        def clean_coordinate(value, default):
-            if value is None:
-                return default
-            cleaned_value = re.sub(r'\s+', '', str(value))
-            if re.match(r'^-?\d+(\.\d+)?$', cleaned_value):
-                return cleaned_value
-            else:
-                return default
-
-        ymax = clean_coordinate(package.get("ymax"), "20")
-        xmax = clean_coordinate(package.get("xmax"), "-13")
-        ymin = clean_coordinate(package.get("ymin"), "-60")
-        xmin = clean_coordinate(package.get("xmin"), "-108")
-
-        def is_tiff(resource):
-            accepted_formats = ['tif','tiff','geotiff']
-            resource_format = resource["format"].lower()
-            return any(resource_format == format for format in accepted_formats)
-
-        if is_tiff(resource):
-            import httpx
-            import matplotlib.pyplot as plt
-            import numpy as np
-
-            def fetch_with_retries(endpoint, params, retries=3, delay=5, timeout=30.0):
-                for attempt in range(retries):
-                    try:
-                        response = httpx.get(endpoint, params=params, timeout=timeout)
-                        response.raise_for_status()
-                        return response
-                    except httpx.ReadTimeout:
-                        print(f"Timeout al intentar acceder a {endpoint} (intento {attempt + 1} de {retries})")
-                        if attempt < retries - 1:
-                            sleep(delay)
-                        else:
-                            raise
-                    except httpx.RequestError as exc:
-                        print(f"Error en la solicitud: {exc} (intento {attempt + 1} de {retries})")
-                        if attempt < retries - 1:
-                            sleep(delay)
-                        else:
-                            raise
-
-            def get_statistics_and_color_scale(url: str):
-                titiler_statistics_endpoint = "https://titiler.dev-wins.com/cog/statistics"
-                titiler_tiles_endpoint = "https://titiler.dev-wins.com/cog/tiles/WebMercatorQuad/{z}/{x}/{y}.png"
-
-                response = fetch_with_retries(titiler_statistics_endpoint, {"url": url})
-
-                stats = response.json()
-                print(json.dumps(stats, indent=4))
-
-                first_band = next(iter(stats.keys()))
-                band_stats = stats[first_band]
-                
-                histogram_counts = band_stats["histogram"][0]
-                bins = band_stats["histogram"][1]
-
-                num_bins = len(bins) - 1
-
-                colormap = []
-
-                if num_bins < 2:
-                    colormap.append(([band_stats["min"], band_stats["max"]], [0, 0, 255, 255]))
-                else:
-                    ranges_per_bin = np.maximum(np.ceil(np.array(histogram_counts) / np.max(histogram_counts) * 3).astype(int), 1)
-
-                    total_ranges = np.sum(ranges_per_bin)
-                    cmap = plt.get_cmap('viridis', total_ranges)
-                    color_index = 0
-
-                    for i in range(num_bins):
-                        bin_start = bins[i]
-                        bin_end = bins[i+1]
-                        bin_ranges = ranges_per_bin[i]
-
-                        if bin_ranges > 0:
-                            range_step = (bin_end - bin_start) / bin_ranges
-                            for j in range(bin_ranges):
-                                range_start = bin_start + j * range_step
-                                range_end = bin_start + (j + 1) * range_step
-                                color = [int(cmap(color_index)[k] * 255) for k in range(4)]
-                                colormap.append(([range_start, range_end], color))
-                                color_index += 1
-
-                cmap_param = json.dumps(colormap)
-                request_url = f"{titiler_tiles_endpoint}?url={url}&bidx=1&colormap={cmap_param}"
-                return request_url, colormap
-
-            def generate_color_list(colormap):
-                color_list = []
-                for color_range, color in colormap:
-                    hex_color = '#{:02x}{:02x}{:02x}'.format(color[0], color[1], color[2])
-                    title = f"{int(color_range[0])} - {int(color_range[1])}"
-                    color_list.append({"title": title, "color": hex_color})
-                return color_list
-
-            def get_zoom_levels(url: str):
-                titiler_info_endpoint = "https://titiler.dev-wins.com/cog/info"
-                response = fetch_with_retries(titiler_info_endpoint, {"url": url})
-                info = response.json()
-                bounds = info.get("bounds", None)
-                minzoom = info.get("minzoom", None)
-                maxzoom = info.get("maxzoom", None)
-                return bounds, minzoom, maxzoom
-
-            result_url, colormap = get_statistics_and_color_scale(uploaded_url)
-            color_scale_list = generate_color_list(colormap)
-            bounds, minzoom, maxzoom = get_zoom_levels(uploaded_url)
-
-            print("Generated URL:")
-            print(result_url)
-            print("\nGenerated Color Scale List:")
-            print(json.dumps(color_scale_list, indent=4))
-            print("\nBounds, Min Zoom, Max Zoom:")
-            print(bounds, minzoom, maxzoom)
-            
-            config = f"""{{
-                "version": "8.0.0",
-                "initSources": [
-                    {{
-                        "catalog": [
-                            {{
-                                "name": "{resource["name"]}",
-                                "type": "url-template-imagery",
-                                "id": "{resource["name"]}",
-                                "name": "{resource["name"]}",
-                                "type": "url-template-imagery",
-                                "url": "{result_url}",
-                                "cacheDuration": "5m",
-                                "isOpenInWorkbench": true,
-                                "minimumLevel": {minzoom},
-                                "maximumLevel": {maxzoom},
-                                "opacity": 0.8,
-                                "legends": [
-                                    {{
-                                        "title": "{resource["name"]}",
-                                        "items": {json.dumps(color_scale_list, indent=4)}
-                                    }}
-                                ]
-                            }}
-                        ],
-                        "homeCamera": {{
-                            "north": {ymax},
-                            "east": {xmax},
-                            "south": {ymin},
-                            "west": {xmin}
-                        }},
-                        "initialCamera": {{
-                            "north": {ymax},
-                            "east": {xmax},
-                            "south": {ymin},
-                            "west": {xmin}
-                        }},
-                        "stratum": "user",
-                        "workbench": [
-                            "{resource["name"]}"
-                        ],
-                        "viewerMode": "2D",
-                        "focusWorkbenchItems": true,
-                        "baseMaps": {{
-                            "defaultBaseMapId": "basemap-positron",
-                            "previewBaseMapId": "basemap-positron"
-                        }}
-                    }}
-                ]
-            }}"""
+        ymax, xmax, ymin, xmin = clean_bbox(package)
+
+        camera = {
+            "north": ymax,
+            "east": xmax,
+            "south": ymin,
+            "west": xmin
+        }
+
+        cog_rendering = None
+        is_tiff = format_lower in TIFF_FORMATS
+        if is_tiff:
+            cog_rendering = get_cog_rendering(uploaded_url, self.titiler_urls)
+
+        if cog_rendering is not None:
+            result_url, color_scale_list, bounds, minzoom, maxzoom = cog_rendering
+            config = build_cog_config(resource["name"], result_url, color_scale_list, minzoom, maxzoom, camera)
         else:
-            config = f"""{{
-                "version": "8.0.0",
-                "initSources": [
-                    {{
-                        "catalog": [
-                            {{
-                                "name": "{resource["name"]}",
-                                "type": "group",
-                                "isOpen": true,
-                                "members": [
-                                    {{
-                                        "id": "{resource["name"]}",
-                                        "name": "{resource["name"]}",
-                                        "type": "{resource["format"].lower()}",
-                                        "url": "{uploaded_url}",
-                                        "cacheDuration": "5m",
-                                        "isOpenInWorkbench": true
-                                    }}
-                                ]
-                            }}
-                        ],
-                        "homeCamera": {{
-                            "north": {ymax},
-                            "east": {xmax},
-                            "south": {ymin},
-                            "west": {xmin}
-                        }},
-                        "initialCamera": {{
-                            "north": {ymax},
-                            "east": {xmax},
-                            "south": {ymin},
-                            "west": {xmin}
-                        }},
-                        "stratum": "user",
-                        "models": {{
-                            "//{resource["name"]}": {{
-                                "isOpen": true,
-                                "knownContainerUniqueIds": [
-                                    "/"
-                                ],
-                                "type": "group"
-                            }},
-                            "{resource["name"]}": {{
-                                "show": true,
-                                "isOpenInWorkbench": true,
-                                "knownContainerUniqueIds": [
-                                    "//{resource["name"]}"
-                                ],
-                                "type": "{resource["format"].lower()}"
-                            }},
-                            "/": {{
-                                "type": "group"
-                            }}
-                        }},
-                        "workbench": [
-                            "{resource["name"]}"
-                        ],
-                        "viewerMode": "3dSmooth",
-                        "focusWorkbenchItems": true,
-                        "baseMaps": {{
-                            "defaultBaseMapId": "basemap-positron",
-                            "previewBaseMapId": "basemap-positron"
-                        }}
-                    }}
-                ]
-            }}"""
-
-        encoded_config = urllib.parse.quote(json.dumps(json.loads(config)))
-        
+            config = build_group_config(resource["name"], format_lower, uploaded_url, camera)
+
+        encoded_config = urllib.parse.quote_from_bytes(_json_bytes(config), safe=CONFIG_SAFE_CHARS)
+
+        # A failed TiTiler lookup should be retried, so its fallback is not kept
+        if not uses_uploader and (cog_rendering is not None or not is_tiff):
+            cache_set(_config_cache, config_key, encoded_config, CONFIG_CACHE_TTL, CONFIG_CACHE_SIZE)
+
+        return self.template_variables(view, encoded_config)
+
+    def template_variables(self, view, encoded_config):
         return {
-            'title': view_title,
-            'terria_instance_url': view_terria_instance_url,
+            'title': view.get('title', self.default_title),
+            'terria_instance_url': view.get('terria_instance_url', self.default_instance_url),
             'encoded_config': encoded_config,
             'origin': self.site_url
         }
@@ -1,5 +1,136 @@
 """Tests for plugin.py."""
+import json
+import urllib.parse
+
+import pytest
+
 import ckanext.terria_view.plugin as plugin
 
 def test_plugin():
-    pass
\ No newline at end of file
+    pass
+
+def test_can_view_resource_formats():
+    assert plugin.can_view_resource({'format': 'GeoJSON', 'url': ''})
+    assert plugin.can_view_resource({'format': 'esri rest', 'url': ''})
+    assert plugin.can_view_resource({'format': 'csv-geo-au', 'url': ''})
+    assert not plugin.can_view_resource({'format': 'csv', 'url': ''})
+    assert not plugin.can_view_resource({'format': 'csv-geo', 'url': ''})
+
+def test_can_view_resource_falls_back_to_url_extension():
+    assert plugin.can_view_resource({'format': '', 'url': 'http://example.com/a.KML'})
+    assert not plugin.can_view_resource({'format': '', 'url': 'http://example.com/a.pdf'})
+
+def test_clean_bbox():
+    package = {'ymax': ' 45.5 ', 'xmax': '200', 'ymin': 'abc', 'xmin': None}
+    assert plugin.clean_bbox(package) == (45.5, 180.0, -60.0, -108.0)
+    assert plugin.clean_bbox({'ymax': 'nan'}) == (20.0, -13.0, -60.0, -108.0)
+
+def test_get_resource_format():
+    assert plugin.get_resource_format({'format': 'GeoTIFF', 'url': ''}) == 'geotiff'
+    assert plugin.get_resource_format({'format': None, 'url': 'http://example.com/a.KML'}) == 'kml'
+
+class FakeResponse(object):
+    def __init__(self, payload):
+        self.payload = payload
+
+    def json(self):
+        return self.payload
+
+@pytest.mark.skipif(not plugin.HAS_COG_SUPPORT, reason='httpx and numpy are required')
+def test_get_statistics_and_color_scale(monkeypatch):
+    stats = {'b1': {'min': 0, 'max': 9, 'histogram': [[187, 10, 0], [0.0, 3.0, 6.0, 9.0]]}}
+    monkeypatch.setattr(plugin, 'fetch_from_titiler',
+                        lambda titiler_urls, path, params: (titiler_urls[0], FakeResponse(stats)))
+    request_url, colormap = plugin.get_statistics_and_color_scale('http://example.com/a.tif', ('http://titiler',))
+    assert request_url.startswith('http://titiler/cog/tiles/WebMercatorQuad/{z}/{x}/{y}.png?url=http://example.com/a.tif')
+    # The busiest bin gets exactly three sub-ranges, the others one each
+    assert [r for r, _ in colormap] == [[0.0, 1.0], [1.0, 2.0], [2.0, 3.0], [3.0, 6.0], [6.0, 9.0]]
+    # Same colours as matplotlib's get_cmap('viridis', 5)
+    assert [c for _, c in colormap] == [
+        [68, 1, 84, 255], [58, 82, 139, 255], [32, 144, 140, 255], [94, 201, 97, 255], [253, 231, 36, 255]
+    ]
+    assert plugin.generate_color_list(colormap)[0] == {'title': '0 - 1', 'color': '#440154'}
+
+class FakeClient(object):
+    # Records every requested url; answers with the next item in responses,
+    # raising it when it is an exception
+    def __init__(self, responses):
+        self.responses = list(responses)
+        self.calls = []
+
+    def get(self, endpoint, params=None, timeout=None):
+        self.calls.append(endpoint)
+        response = self.responses.pop(0) if len(self.responses) > 1 else self.responses[0]
+        if isinstance(response, Exception):
+            raise response
+        return response
+
+class FakeHTTPResponse(FakeResponse):
+    def raise_for_status(self):
+        pass
+
+def use_fake_client(monkeypatch, responses):
+    client = FakeClient(responses)
+    monkeypatch.setattr(plugin, 'get_http_client', lambda: client)
+    monkeypatch.setattr(plugin.time, 'sleep', lambda delay: None)
+    monkeypatch.setattr(plugin, '_titiler_cache', {})
+    monkeypatch.setattr(plugin, '_titiler_failures', {})
+    monkeypatch.setattr(plugin, '_config_cache', {})
+    return client
+
+@pytest.mark.skipif(not plugin.HAS_COG_SUPPORT, reason='httpx and numpy are required')
+def test_fetch_from_titiler_fails_over_to_backup(monkeypatch):
+    client = use_fake_client(monkeypatch, [plugin.httpx.ConnectError('down'), FakeHTTPResponse({})])
+    titiler_url, _ = plugin.fetch_from_titiler(('http://a', 'http://b'), '/cog/info', {})
+    assert titiler_url == 'http://b'
+    assert client.calls == ['http://a/cog/info', 'http://b/cog/info']
+
+@pytest.mark.skipif(not plugin.HAS_COG_SUPPORT, reason='httpx and numpy are required')
+def test_fetch_from_titiler_retries_only_last_endpoint(monkeypatch):
+    client = use_fake_client(monkeypatch, [plugin.httpx.ConnectError('down')])
+    with pytest.raises(plugin.httpx.ConnectError):
+        plugin.fetch_from_titiler(('http://a', 'http://b'), '/cog/info', {})
+    assert client.calls == ['http://a/cog/info'] + ['http://b/cog/info'] * 3
+
+@pytest.mark.skipif(not plugin.HAS_COG_SUPPORT, reason='httpx and numpy are required')
+def test_fetch_from_titiler_stops_retrying_at_deadline(monkeypatch):
+    client = use_fake_client(monkeypatch, [plugin.httpx.ConnectError('down')])
+    monkeypatch.setattr(plugin, 'TITILER_ENDPOINT_BUDGET', 0.0)
+    with pytest.raises(plugin.httpx.ConnectError):
+        plugin.fetch_from_titiler(('http://a',), '/cog/info', {})
+    assert client.calls == ['http://a/cog/info']
+
+@pytest.mark.skipif(not plugin.HAS_COG_SUPPORT, reason='httpx and numpy are required')
+def test_get_cog_rendering_remembers_failures(monkeypatch):
+    client = use_fake_client(monkeypatch, [plugin.httpx.ConnectError('down')])
+    assert plugin.get_cog_rendering('http://example.com/a.tif', ('http://a',)) is None
+    assert client.calls
+    client.calls = []
+    assert plugin.get_cog_rendering('http://example.com/a.tif', ('http://a',)) is None
+    assert client.calls == []
+
+@pytest.mark.skipif(not plugin.HAS_COG_SUPPORT, reason='httpx and numpy are required')
+def test_malformed_titiler_response_falls_back_to_plain_config(monkeypatch):
+    use_fake_client(monkeypatch, [FakeHTTPResponse({})])
+    monkeypatch.setattr(plugin.toolkit, 'g', type('G', (object,), {'user': None})())
+    terria = plugin.Terria_ViewPlugin()
+    terria.titiler_urls = ('http://a',)
+    data_dict = {
+        'package': {'name': 'dataset', 'organization': {'id': 'org'}},
+        'resource': {'id': 'res', 'name': 'raster', 'format': 'GeoTIFF', 'url': 'http://example.com/a.tif'},
+        'resource_view': {}
+    }
+    variables = terria.setup_template_variables({}, data_dict)
+    config = json.loads(urllib.parse.unquote(variables['encoded_config']))
+    member = config['initSources'][0]['catalog'][0]['members'][0]
+    assert member['type'] == 'geotiff'
+    assert member['url'] == 'http://example.com/a.tif'
+
+def test_info_is_not_shared_between_calls(monkeypatch):
+    monkeypatch.setattr(plugin.toolkit, '_', lambda text: text)
+    terria = plugin.Terria_ViewPlugin()
+    info = terria.info()
+    info['schema']['terria_instance_url'].append('changed')
+    info['title'] = 'changed'
+    assert terria.info()['schema'] == {'terria_instance_url': []}
+    assert terria.info()['title'] == 'TerriaJS Preview'